@@ -1,12 +1,31 @@
 
 import os
 import time
+import numpy as np
 import torch
 import torchvision as tv
 from torch import nn, optim
 from torch.utils.data.sampler import SubsetRandomSampler, SequentialSampler
 
 
+def save_indices(save_path, name, indices):
+    """
+    Saves a data split as name.npy, which loads without unpickling
+    """
+    np.save(os.path.join(save_path, name + '.npy'), indices.numpy().astype(np.int64))
+
+
+def load_indices(load_path, name):
+    """
+    Loads a data split from name.npy, or from name.pth for splits
+    saved by older versions
+    """
+    npy_path = os.path.join(load_path, name + '.npy')
+    if os.path.exists(npy_path):
+        return torch.from_numpy(np.load(npy_path))
+    return torch.load(os.path.join(load_path, name + '.pth'))
+
+
 class Data():
     """
     A base class of data importers
@@ -30,7 +49,7 @@ class Data():
      
 class DS_cifar100(Data):
     
-    def __init__(self, data_name, data_path, batch_size, valid_size=0, save_path='./data', load_path=None, download=False, num_workers=1):
+    def __init__(self, data_name, data_path, batch_size, valid_size=0, save_path='./data', load_path=None, download=False, num_workers=4):
         Data.__init__(self, data_name)
         self.mean=[0.5071, 0.4867, 0.4408]  
         self.stdv=[0.2675, 0.2565, 0.2761]    
@@ -67,10 +86,10 @@ class DS_cifar100(Data):
             self.train_indices = torch.randperm(len(train_set))
             
         else:
-            if load_path is not None: # use data split already done in load_path, using train_indices.pth, valid_indices.pth, test_indices.pth
-                self.train_indices = torch.load(os.path.join(load_path, 'train_indices.pth'))
-                self.valid_indices = torch.load(os.path.join(load_path, 'valid_indices.pth'))
-                self.test_indices = torch.load(os.path.join(load_path, 'test_indices.pth'))
+            if load_path is not None: # use data split already done in load_path, using train_indices, valid_indices, test_indices (.npy or .pth)
+                self.train_indices = load_indices(load_path, 'train_indices')
+                self.valid_indices = load_indices(load_path, 'valid_indices')
+                self.test_indices = load_indices(load_path, 'test_indices')
             else: # Do new data split
                 indices = torch.randperm(len(train_set))
                 self.train_indices = indices[:len(indices) - self.valid_size]
@@ -78,17 +97,20 @@ class DS_cifar100(Data):
                 self.test_indices = torch.randperm(len(test_set))
                 if not os.path.isdir(save_path):
                     os.mkdir(save_path)
-                torch.save(self.train_indices, os.path.join(save_path, 'train_indices.pth'))
-                torch.save(self.valid_indices, os.path.join(save_path, 'valid_indices.pth'))
-                torch.save(self.test_indices, os.path.join(save_path, 'test_indices.pth'))
+                save_indices(save_path, 'train_indices', self.train_indices)
+                save_indices(save_path, 'valid_indices', self.valid_indices)
+                save_indices(save_path, 'test_indices', self.test_indices)
         # Make dataloaders
         self.train_loader = torch.utils.data.DataLoader(train_set, pin_memory=True, batch_size=self.batch_size, num_workers=self.num_workers,
+                                               persistent_workers=self.num_workers > 0, prefetch_factor=4 if self.num_workers > 0 else None,
                                                sampler=SubsetRandomSampler(self.train_indices))
         if self.valid_size == 0:
             print('valid size = 0..test_set as valid set')
-            self.valid_loader = torch.utils.data.DataLoader(test_set, shuffle=False, batch_size=self.batch_size)
+            self.valid_loader = torch.utils.data.DataLoader(test_set, shuffle=False, pin_memory=True, batch_size=self.batch_size, num_workers=self.num_workers,
+                                               persistent_workers=self.num_workers > 0, prefetch_factor=4 if self.num_workers > 0 else None)
         else:
             self.valid_loader = torch.utils.data.DataLoader(valid_set, pin_memory=True, batch_size=self.batch_size, num_workers=self.num_workers,
+                                               persistent_workers=self.num_workers > 0, prefetch_factor=4 if self.num_workers > 0 else None,
                                                sampler=SubsetRandomSampler(self.valid_indices))
         #self.test_loader = torch.utils.data.DataLoader(test_set, pin_memory=True, batch_size=self.batch_size,
         #                                       sampler=SubsetRandomSampler(self.test_indices))
@@ -101,7 +123,7 @@ class DS_cifar100(Data):
 
 class DS_cifar10(Data):
     
-    def __init__(self, data_name, data_path, batch_size, valid_size=0, save_path='./data', load_path=None, download=False, num_workers=1):
+    def __init__(self, data_name, data_path, batch_size, valid_size=0, save_path='./data', load_path=None, download=False, num_workers=4):
         Data.__init__(self, data_name)
         self.mean=[0.4914, 0.4823, 0.4465]  
         self.stdv=[0.247, 0.243, 0.261]    
@@ -138,10 +160,10 @@ class DS_cifar10(Data):
             self.train_indices = torch.randperm(len(train_set))
         else:
             
-            if load_path is not None: # use data split already done in load_path, using train_indices.pth, valid_indices.pth, test_indices.pth
-                self.train_indices = torch.load(os.path.join(load_path, 'train_indices.pth'))
-                self.valid_indices = torch.load(os.path.join(load_path, 'valid_indices.pth'))
-                self.test_indices = torch.load(os.path.join(load_path, 'test_indices.pth'))
+            if load_path is not None: # use data split already done in load_path, using train_indices, valid_indices, test_indices (.npy or .pth)
+                self.train_indices = load_indices(load_path, 'train_indices')
+                self.valid_indices = load_indices(load_path, 'valid_indices')
+                self.test_indices = load_indices(load_path, 'test_indices')
             else: # Do new data split
                 indices = torch.randperm(len(train_set))
                 self.train_indices = indices[:len(indices) - self.valid_size]
@@ -149,18 +171,21 @@ class DS_cifar10(Data):
                 self.test_indices = torch.randperm(len(test_set))
                 if not os.path.isdir(save_path):
                     os.mkdir(save_path)
-                torch.save(self.train_indices, os.path.join(save_path, 'train_indices.pth'))
-                torch.save(self.valid_indices, os.path.join(save_path, 'valid_indices.pth'))
-                torch.save(self.test_indices, os.path.join(save_path, 'test_indices.pth'))
+                save_indices(save_path, 'train_indices', self.train_indices)
+                save_indices(save_path, 'valid_indices', self.valid_indices)
+                save_indices(save_path, 'test_indices', self.test_indices)
          
         # Make dataloaders
         self.train_loader = torch.utils.data.DataLoader(train_set, pin_memory=True, batch_size=self.batch_size, num_workers=self.num_workers,
+                                               persistent_workers=self.num_workers > 0, prefetch_factor=4 if self.num_workers > 0 else None,
                                                sampler=SubsetRandomSampler(self.train_indices))
         if self.valid_size == 0:
             print('valid size = 0..test_set as valid set')
-            self.valid_loader = torch.utils.data.DataLoader(test_set, shuffle=False, batch_size=self.batch_size)
+            self.valid_loader = torch.utils.data.DataLoader(test_set, shuffle=False, pin_memory=True, batch_size=self.batch_size, num_workers=self.num_workers,
+                                               persistent_workers=self.num_workers > 0, prefetch_factor=4 if self.num_workers > 0 else None)
         else:
             self.valid_loader = torch.utils.data.DataLoader(valid_set, pin_memory=True, batch_size=self.batch_size, num_workers=self.num_workers,
+                                               persistent_workers=self.num_workers > 0, prefetch_factor=4 if self.num_workers > 0 else None,
                                                sampler=SubsetRandomSampler(self.valid_indices))
         
         #self.test_loader = torch.utils.data.DataLoader(test_set, pin_memory=True, batch_size=self.batch_size,
@@ -173,7 +198,7 @@ class DS_cifar10(Data):
     
 class DS_imagenet(Data):
     
-    def __init__(self, data_name, data_path, batch_size, valid_size=0, save_path='./data', load_path=None, download=False, num_workers=1):
+    def __init__(self, data_name, data_path, batch_size, valid_size=0, save_path='./data', load_path=None, download=False, num_workers=4):
         Data.__init__(self, data_name)
         self.mean=[0.485, 0.456, 0.406]
         self.stdv=[0.229, 0.224, 0.225]    
@@ -207,10 +232,10 @@ class DS_imagenet(Data):
         train_set = tv.datasets.ImageNet(data_path, split='train', transform=train_transforms, download=self.download)
         valid_set = tv.datasets.ImageNet(data_path, split='train', transform=test_transforms, download=False)
         test_set = tv.datasets.ImageNet(data_path, split='val', transform=test_transforms, download=False)
-        if load_path is not None: # use data split already done in load_path, using train_indices.pth, valid_indices.pth, test_indices.pth
-            self.train_indices = torch.load(os.path.join(load_path, 'train_indices.pth'))
-            self.valid_indices = torch.load(os.path.join(load_path, 'valid_indices.pth'))
-            self.test_indices = torch.load(os.path.join(load_path, 'test_indices.pth'))
+        if load_path is not None: # use data split already done in load_path, using train_indices, valid_indices, test_indices (.npy or .pth)
+            self.train_indices = load_indices(load_path, 'train_indices')
+            self.valid_indices = load_indices(load_path, 'valid_indices')
+            self.test_indices = load_indices(load_path, 'test_indices')
         else: # Do new data split
             indices = torch.randperm(len(train_set))
             print('train_set, test_set')
@@ -222,13 +247,15 @@ class DS_imagenet(Data):
             self.test_indices = torch.randperm(len(test_set))
             if not os.path.isdir(save_path):
                 os.mkdir(save_path)
-            torch.save(self.train_indices, os.path.join(save_path, 'train_indices.pth'))
-            torch.save(self.valid_indices, os.path.join(save_path, 'valid_indices.pth'))
-            torch.save(self.test_indices, os.path.join(save_path, 'test_indices.pth'))
+            save_indices(save_path, 'train_indices', self.train_indices)
+            save_indices(save_path, 'valid_indices', self.valid_indices)
+            save_indices(save_path, 'test_indices', self.test_indices)
         # Make dataloaders
         self.train_loader = torch.utils.data.DataLoader(train_set, pin_memory=True, batch_size=self.batch_size, num_workers=self.num_workers,
+                                               persistent_workers=self.num_workers > 0, prefetch_factor=4 if self.num_workers > 0 else None,
                                                sampler=SubsetRandomSampler(self.train_indices))
         self.valid_loader = torch.utils.data.DataLoader(valid_set, pin_memory=True, batch_size=self.batch_size, num_workers=self.num_workers,
+                                               persistent_workers=self.num_workers > 0, prefetch_factor=4 if self.num_workers > 0 else None,
                                                sampler=SubsetRandomSampler(self.valid_indices))
         #self.test_loader = torch.utils.data.DataLoader(test_set, pin_memory=True, batch_size=self.batch_size,
         #                                       sampler=SubsetRandomSampler(self.test_indices))
@@ -5,6 +5,7 @@ import torch
 import torchvision as tv
 from torch import nn, optim
 from torch.utils.data.sampler import SubsetRandomSampler, SequentialSampler
+from MLLib.data_importer.datasets import save_indices, load_indices
 
 
 class Data():
@@ -62,10 +63,10 @@ class DS_cifar100(Data):
         train_set = tv.datasets.CIFAR100(data_path, train=True, transform=train_transforms, download=self.download)
         valid_set = tv.datasets.CIFAR100(data_path, train=True, transform=test_transforms, download=False)
         test_set = tv.datasets.CIFAR100(data_path, train=False, transform=test_transforms, download=False)
-        if load_path is not None: # use data split already done in load_path, using train_indices.pth, valid_indices.pth, test_indices.pth
-            self.train_indices = torch.load(os.path.join(load_path, 'train_indices.pth'))
-            self.valid_indices = torch.load(os.path.join(load_path, 'valid_indices.pth'))
-            self.test_indices = torch.load(os.path.join(load_path, 'test_indices.pth'))
+        if load_path is not None: # use data split already done in load_path, using train_indices, valid_indices, test_indices (.npy or .pth)
+            self.train_indices = load_indices(load_path, 'train_indices')
+            self.valid_indices = load_indices(load_path, 'valid_indices')
+            self.test_indices = load_indices(load_path, 'test_indices')
         else: # Do new data split
             indices = torch.randperm(len(train_set))
             self.train_indices = indices[:len(indices) - self.valid_size]
@@ -73,9 +74,9 @@ class DS_cifar100(Data):
             self.test_indices = torch.randperm(len(test_set))
             if not os.path.isdir(save_path):
                 os.mkdir(save_path)
-            torch.save(self.train_indices, os.path.join(save_path, 'train_indices.pth'))
-            torch.save(self.valid_indices, os.path.join(save_path, 'valid_indices.pth'))
-            torch.save(self.test_indices, os.path.join(save_path, 'test_indices.pth'))
+            save_indices(save_path, 'train_indices', self.train_indices)
+            save_indices(save_path, 'valid_indices', self.valid_indices)
+            save_indices(save_path, 'test_indices', self.test_indices)
         # Make dataloaders
         self.train_loader = torch.utils.data.DataLoader(train_set, pin_memory=True, batch_size=self.batch_size, num_workers=self.num_workers,
                                                sampler=SubsetRandomSampler(self.train_indices))
@@ -124,10 +125,10 @@ class DS_cifar10(Data):
         train_set = tv.datasets.CIFAR10(data_path, train=True, transform=train_transforms, download=self.download)
         valid_set = tv.datasets.CIFAR10(data_path, train=True, transform=test_transforms, download=False)
         test_set = tv.datasets.CIFAR10(data_path, train=False, transform=test_transforms, download=False)
-        if load_path is not None: # use data split already done in load_path, using train_indices.pth, valid_indices.pth, test_indices.pth
-            self.train_indices = torch.load(os.path.join(load_path, 'train_indices.pth'))
-            self.valid_indices = torch.load(os.path.join(load_path, 'valid_indices.pth'))
-            self.test_indices = torch.load(os.path.join(load_path, 'test_indices.pth'))
+        if load_path is not None: # use data split already done in load_path, using train_indices, valid_indices, test_indices (.npy or .pth)
+            self.train_indices = load_indices(load_path, 'train_indices')
+            self.valid_indices = load_indices(load_path, 'valid_indices')
+            self.test_indices = load_indices(load_path, 'test_indices')
         else: # Do new data split
             indices = torch.randperm(len(train_set))
             self.train_indices = indices[:len(indices) - self.valid_size]
@@ -135,9 +136,9 @@ class DS_cifar10(Data):
             self.test_indices = torch.randperm(len(test_set))
             if not os.path.isdir(save_path):
                 os.mkdir(save_path)
-            torch.save(self.train_indices, os.path.join(save_path, 'train_indices.pth'))
-            torch.save(self.valid_indices, os.path.join(save_path, 'valid_indices.pth'))
-            torch.save(self.test_indices, os.path.join(save_path, 'test_indices.pth'))
+            save_indices(save_path, 'train_indices', self.train_indices)
+            save_indices(save_path, 'valid_indices', self.valid_indices)
+            save_indices(save_path, 'test_indices', self.test_indices)
         # Make dataloaders
         self.train_loader = torch.utils.data.DataLoader(train_set, pin_memory=True, batch_size=self.batch_size, num_workers=self.num_workers,
                                                sampler=SubsetRandomSampler(self.train_indices))
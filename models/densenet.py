@@ -11,7 +11,7 @@ from collections import OrderedDict
 
 def _bn_function_factory(norm, relu, conv):
     def bn_function(*inputs):
-        concated_features = torch.cat(inputs, 1)
+        concated_features = inputs[0] if len(inputs) == 1 else torch.cat(inputs, 1)
         bottleneck_output = conv(relu(norm(concated_features)))
         return bottleneck_output
 
@@ -35,7 +35,7 @@ class _DenseLayer(nn.Module):
     def forward(self, *prev_features):
         bn_function = _bn_function_factory(self.norm1, self.relu1, self.conv1)
         if self.efficient and any(prev_feature.requires_grad for prev_feature in prev_features):
-            bottleneck_output = cp.checkpoint(bn_function, *prev_features)
+            bottleneck_output = cp.checkpoint(bn_function, *prev_features, use_reentrant=False)
         else:
             bottleneck_output = bn_function(*prev_features)
         new_features = self.conv2(self.relu2(self.norm2(bottleneck_output)))
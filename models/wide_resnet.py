@@ -8,21 +8,20 @@
 import torchvision.transforms as transforms
 import torch.nn as nn
 import torch.nn.init as init
-import torch.nn.functional as F
 import math
+from torch.jit import Final
 
 __all__ = ['wide_resnet28_10', 'wide_resnet28_12', 'wide_leaky_resnet28_10']
 
 
 def conv3x3(in_planes, out_planes, stride=1):
-    return nn.Conv2d(in_planes, out_planes, kernel_size=3, stride=stride, padding=1, bias=True)
+    return nn.Conv2d(in_planes, out_planes, kernel_size=3, stride=stride, padding=1, bias=False)
 
 
 def conv_init(m):
     classname = m.__class__.__name__
     if classname.find('Conv') != -1:
         init.kaiming_normal_(m.weight)
-        init.constant_(m.bias, 0)
     elif classname.find('BatchNorm') != -1:
         init.constant_(m.weight, 1)
         init.constant_(m.bias, 0)
@@ -31,44 +30,46 @@ def conv_leak_init(m):
     classname = m.__class__.__name__
     if classname.find('Conv') != -1:
         init.kaiming_normal_(m.weight, a=0.2)
-        init.constant_(m.bias, 0)
     elif classname.find('BatchNorm') != -1:
         init.constant_(m.weight, 1)
         init.constant_(m.bias, 0)
 
 class WideBasic(nn.Module):
+    leak: Final[bool]
+
     def __init__(self, in_planes, planes, dropout_rate, stride=1, leak=False):
         super(WideBasic, self).__init__()
         self.leak = leak
+        self.act = nn.LeakyReLU(negative_slope=0.2, inplace=True) if leak else nn.ReLU(inplace=True)
         self.bn1 = nn.BatchNorm2d(in_planes)
-        self.conv1 = nn.Conv2d(in_planes, planes, kernel_size=3, padding=1, bias=True)
+        self.conv1 = nn.Conv2d(in_planes, planes, kernel_size=3, padding=1, bias=False)
         self.dropout = nn.Dropout(p=dropout_rate)
         self.bn2 = nn.BatchNorm2d(planes)
-        self.conv2 = nn.Conv2d(planes, planes, kernel_size=3, stride=stride, padding=1, bias=True)
+        self.conv2 = nn.Conv2d(planes, planes, kernel_size=3, stride=stride, padding=1, bias=False)
 
         self.shortcut = nn.Sequential()
         if stride != 1 or in_planes != planes:
             self.shortcut = nn.Sequential(
-                nn.Conv2d(in_planes, planes, kernel_size=1, stride=stride, bias=True),
+                nn.Conv2d(in_planes, planes, kernel_size=1, stride=stride, bias=False),
             )
 
     def forward(self, x):
-        if self.leak:
-            out = self.dropout(self.conv1(F.leaky_relu(self.bn1(x), negative_slope=0.2)))
-            out = self.conv2(F.leaky_relu(self.bn2(out), negative_slope=0.2))
-        else:
-            out = self.dropout(self.conv1(F.relu(self.bn1(x))))
-            out = self.conv2(F.relu(self.bn2(out)))
+        # activations run in place on the BN output to save a memory pass
+        out = self.dropout(self.conv1(self.act(self.bn1(x))))
+        out = self.conv2(self.act(self.bn2(out)))
         out += self.shortcut(x)
 
         return out
 
 
 class WideResNet(nn.Module):
+    leak: Final[bool]
+
     def __init__(self, num_classes=10, depth=28, widen_factor=10, dropout_rate=0., leak=False):
         super(WideResNet, self).__init__()
         self.in_planes = 16
         self.leak = leak
+        self.act = nn.LeakyReLU(negative_slope=0.2, inplace=True) if leak else nn.ReLU(inplace=True)
 
         assert ((depth - 4) % 6 == 0), 'Wide-resnet depth should be 6n+4'
         n = (depth - 4) / 6
@@ -98,12 +99,8 @@ class WideResNet(nn.Module):
         out = self.layer1(out)
         out = self.layer2(out)
         out = self.layer3(out)
-        if self.leak:
-            out = F.leaky_relu(self.bn1(out), negative_slope=0.2)
-        else:
-            out = F.relu(self.bn1(out))
-        out = F.avg_pool2d(out, out.size(3))
-        out = out.view(out.size(0), -1)
+        out = self.act(self.bn1(out))
+        out = out.mean(dim=[2, 3])
         out = self.linear(out)
         return out
 
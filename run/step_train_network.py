@@ -8,7 +8,6 @@ try:
     import _pickle as pickle
 except:
     import pickle
-import time
 import torch
 import torchvision as tv
 from torch import nn, optim
@@ -16,8 +15,8 @@ from torch.utils.data.sampler import SubsetRandomSampler
 from torchvision.models.densenet import *
 from torchvision.models.resnet import *
 from MLLib.models.densenet import DenseNet
-from MLLib.models.model_generator import get_model
-from MLLib.utils.utils import Meter, move_to_device, get_para_num, xavier_init_weights, kaiming_normal_init_weights
+from MLLib.models.model_generator import get_model, wide_resnet_names
+from MLLib.utils.utils import Meter, StepTimer, GraphedStep, move_to_device, get_para_num, xavier_init_weights, kaiming_normal_init_weights, fuse_conv_bn
 from MLLib.utils.temperature_scaling import ModelWithTemperature
 #from MLLib.data_importer.ds_cifar import DS_cifar100, DS_cifar10
 from MLLib.data_importer.datasets import *
@@ -30,7 +29,24 @@ commandLineParser.add_argument('destination_dir', type=str,
 commandLineParser.add_argument('--device_type', type=str, choices=['cpu', 'cuda'], default='cuda',
                                help='choose to run on gpu or cpu')
 
-def run_epoch_fast(loader, model, criterion, optimizer, device_type='cuda', epoch=0, n_epochs=0, train=True, log_every_step=True):
+def move_batch_to_device(input, target, device_type, channels_last=False):
+    # Batches come from pinned memory, so the copies overlap with compute
+    input = input.to(device_type, non_blocking=True)
+    target = target.to(device_type, non_blocking=True)
+    # NHWC inputs let cuDNN pick its native channels_last kernels without
+    # transposing every activation. Reformat after the copy, on the device
+    if channels_last and input.dim() == 4:
+        input = input.contiguous(memory_format=torch.channels_last)
+    return input, target
+
+def script_model(model, net_arch, trn_para):
+    # trn_para['jit'] scripts the wide resnets, which have a fixed activation
+    # per instance; other models are returned as they are
+    if trn_para.get('jit', False) and net_arch['model_name'] in wide_resnet_names:
+        return torch.jit.script(model)
+    return model
+
+def run_epoch_fast(loader, model, criterion, optimizer, device_type='cuda', epoch=0, n_epochs=0, train=True, log_every_step=True, channels_last=False, scaler=None, amp_dtype=None, log_interval=20, graphed_step=None):
     time_meter = Meter(name='Time', cum=True)
     loss_meter = Meter(name='Loss', cum=False)
     error_meter = Meter(name='Error', cum=False)
@@ -42,53 +58,81 @@ def run_epoch_fast(loader, model, criterion, optimizer, device_type='cuda', epoc
         model.eval()
         print('Evaluating')
 
-    end = time.time()
+    # Loss and correct predictions are summed on device and only copied to
+    # the meters every log_interval steps, to avoid a host sync per step
+    timer = StepTimer(device_type)
+    n_batches = len(loader)
+    # the lr only changes when the scheduler steps, between epochs
+    lr_value = optimizer.param_groups[0]['lr']
+    loss_sum = 0.
+    n_correct = 0
+    n_seen = 0
+    n_steps = 0
     for i, (input, target) in enumerate(loader):
         if train:
-            model.zero_grad()
-            optimizer.zero_grad()
-
-            # Forward pass
-            input = move_to_device(input, device_type, False)
-            target = move_to_device(target, device_type, False)
-            output = model(input)
-            loss = criterion(output, target)
-
-            # Backward pass
-            if loss.item()>0:
-                loss.backward()
-                optimizer.step()
+            input, target = move_batch_to_device(input, target, device_type, channels_last)
+            if graphed_step is not None and graphed_step.matches(input):
+                # Forward and backward pass replayed from the CUDA graph
+                output, loss = graphed_step(input, target)
+                nonzero_loss = loss.item() > 0
+            else:
+                # keep the .grad tensors captured by graphed_step, if any
+                optimizer.zero_grad(set_to_none=graphed_step is None)
+
+                # Forward pass
+                with torch.autocast(device_type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                    output = model(input)
+                    loss = criterion(output, target)
+
+                # Backward pass, skipped for a zero loss batch
+                nonzero_loss = loss.item() > 0
+                if nonzero_loss:
+                    if scaler is not None:
+                        scaler.scale(loss).backward()
+                    else:
+                        loss.backward()
+            # a zero loss batch does not step either, so weight decay and
+            # momentum are not applied for it
+            if nonzero_loss:
+                if scaler is not None:
+                    scaler.step(optimizer)
+                    scaler.update()
+                else:
+                    optimizer.step()
             optimizer.n_iters = optimizer.n_iters + 1 if hasattr(optimizer, 'n_iters') else 1
 
         else:
             with torch.no_grad():
                 # Forward pass
-                input = move_to_device(input, device_type, False)
-                target = move_to_device(target, device_type, False)
-                output = model(input)
-                loss = criterion(output, target)
+                input, target = move_batch_to_device(input, target, device_type, channels_last)
+                with torch.autocast(device_type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                    output = model(input)
+                    loss = criterion(output, target)
 
         # Accounting
-        _, predictions = torch.topk(output, 1)
-        error = 1 - torch.eq(torch.squeeze(predictions), target).float().mean()
-        batch_time = time.time() - end
-        end = time.time()
+        loss_sum += loss.detach()
+        n_correct += (output.argmax(dim=1) == target).sum()
+        n_seen += target.size(0)
+        n_steps += 1
 
         # Log errors
-        time_meter.update(batch_time)
-        loss_meter.update(loss)
-        error_meter.update(error)
-        if log_every_step: 
-            for param_group in optimizer.param_groups:
-                lr_value=param_group['lr']
-            print('  '.join([
-                '%s: (Epoch %d of %d) [%04d/%04d]' % ('Train' if train else 'Eval',
-                epoch, n_epochs, i + 1, len(loader)),
-                str(time_meter),
-                str(loss_meter),
-                str(error_meter),
-                '%.4f' % lr_value
-            ]))
+        if (log_every_step and (i + 1) % log_interval == 0) or i + 1 == n_batches:
+            time_meter.update(timer.lap() / n_steps, n_steps)
+            loss_meter.update(loss_sum / n_steps, n_steps)
+            error_meter.update(1 - n_correct.float() / n_seen, n_seen)
+            loss_sum = 0.
+            n_correct = 0
+            n_seen = 0
+            n_steps = 0
+            if log_every_step:
+                print('  '.join([
+                    '%s: (Epoch %d of %d) [%04d/%04d]' % ('Train' if train else 'Eval',
+                    epoch, n_epochs, i + 1, n_batches),
+                    str(time_meter),
+                    str(loss_meter),
+                    str(error_meter),
+                    '%.4f' % lr_value
+                ]))
 
     if not log_every_step:
         print('  '.join([
@@ -103,7 +147,7 @@ def run_epoch_fast(loader, model, criterion, optimizer, device_type='cuda', epoc
 
     return time_meter.value(), loss_meter.value(), error_meter.value()
 
-def run_epoch(loader, model, criterion, optimizer, device_type='cuda', epoch=0, n_epochs=0, train=True, log_every_step=True):
+def run_epoch(loader, model, criterion, optimizer, device_type='cuda', epoch=0, n_epochs=0, train=True, log_every_step=True, channels_last=False, scaler=None, amp_dtype=None, log_interval=20, graphed_step=None):
     time_meter = Meter(name='Time', cum=True)
     loss_meter = Meter(name='Loss', cum=False)
     error_meter = Meter(name='Error', cum=False)
@@ -115,52 +159,75 @@ def run_epoch(loader, model, criterion, optimizer, device_type='cuda', epoch=0,
         model.eval()
         print('Evaluating')
 
-    end = time.time()
+    # Loss and correct predictions are summed on device and only copied to
+    # the meters every log_interval steps, to avoid a host sync per step
+    timer = StepTimer(device_type)
+    n_batches = len(loader)
+    # the lr only changes when the scheduler steps, between epochs
+    lr_value = optimizer.param_groups[0]['lr']
+    loss_sum = 0.
+    n_correct = 0
+    n_seen = 0
+    n_steps = 0
     for i, (input, target) in enumerate(loader):
         if train:
-            model.zero_grad()
-            optimizer.zero_grad()
-
-            # Forward pass
-            input = move_to_device(input, device_type, False)
-            target = move_to_device(target, device_type, False)
-            output = model(input)
-            loss = criterion(output, target)
-
-            # Backward pass
-            loss.backward()
-            optimizer.step()
+            input, target = move_batch_to_device(input, target, device_type, channels_last)
+            if graphed_step is not None and graphed_step.matches(input):
+                # Forward and backward pass replayed from the CUDA graph
+                output, loss = graphed_step(input, target)
+            else:
+                # keep the .grad tensors captured by graphed_step, if any
+                optimizer.zero_grad(set_to_none=graphed_step is None)
+
+                # Forward pass
+                with torch.autocast(device_type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                    output = model(input)
+                    loss = criterion(output, target)
+
+                # Backward pass
+                if scaler is not None:
+                    scaler.scale(loss).backward()
+                else:
+                    loss.backward()
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
             optimizer.n_iters = optimizer.n_iters + 1 if hasattr(optimizer, 'n_iters') else 1
 
         else:
             with torch.no_grad():
                 # Forward pass
-                input = move_to_device(input, device_type, False)
-                target = move_to_device(target, device_type, False)
-                output = model(input)
-                loss = criterion(output, target)
+                input, target = move_batch_to_device(input, target, device_type, channels_last)
+                with torch.autocast(device_type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                    output = model(input)
+                    loss = criterion(output, target)
 
         # Accounting
-        _, predictions = torch.topk(output, 1)
-        error = 1 - torch.eq(torch.squeeze(predictions), target).float().mean()
-        batch_time = time.time() - end
-        end = time.time()
+        loss_sum += loss.detach()
+        n_correct += (output.argmax(dim=1) == target).sum()
+        n_seen += target.size(0)
+        n_steps += 1
 
         # Log errors
-        time_meter.update(batch_time)
-        loss_meter.update(loss)
-        error_meter.update(error)
-        if log_every_step: 
-            for param_group in optimizer.param_groups:
-                lr_value=param_group['lr']
-            print('  '.join([
-                '%s: (Epoch %d of %d) [%04d/%04d]' % ('Train' if train else 'Eval',
-                epoch, n_epochs, i + 1, len(loader)),
-                str(time_meter),
-                str(loss_meter),
-                str(error_meter),
-                '%.4f' % lr_value
-            ]))
+        if (log_every_step and (i + 1) % log_interval == 0) or i + 1 == n_batches:
+            time_meter.update(timer.lap() / n_steps, n_steps)
+            loss_meter.update(loss_sum / n_steps, n_steps)
+            error_meter.update(1 - n_correct.float() / n_seen, n_seen)
+            loss_sum = 0.
+            n_correct = 0
+            n_seen = 0
+            n_steps = 0
+            if log_every_step:
+                print('  '.join([
+                    '%s: (Epoch %d of %d) [%04d/%04d]' % ('Train' if train else 'Eval',
+                    epoch, n_epochs, i + 1, n_batches),
+                    str(time_meter),
+                    str(loss_meter),
+                    str(error_meter),
+                    '%.4f' % lr_value
+                ]))
 
     if not log_every_step:
         print('  '.join([
@@ -201,7 +268,26 @@ def train(dataset, net_arch, trn_para, save, device_type='cuda', model_filename=
         model = xavier_init_weights(model)
     elif trn_para['weight_init'] == 'kaiming':
         model = kaiming_normal_init_weights(model)
+    # script after the weight init, which only matches eager nn modules
+    model = script_model(model, net_arch, trn_para)
     model_wrapper = move_to_device(model, device_type, True)
+    # DenseNet gains little from NHWC, only reformat the wide resnets
+    channels_last = net_arch['model_name'] in wide_resnet_names
+    if channels_last:
+        model_wrapper = model_wrapper.to(memory_format=torch.channels_last)
+    # set trn_para['compile'] = False to debug in eager mode, scripted
+    # models are not compiled, and 'reduce-overhead' already uses CUDA graphs
+    # so it is not combined with trn_para['cuda_graph']
+    use_cuda_graph = device_type == 'cuda' and trn_para.get('cuda_graph', False)
+    if device_type == 'cuda' and trn_para.get('compile', True) and not isinstance(model, torch.jit.ScriptModule) and not use_cuda_graph:
+        model_wrapper = torch.compile(model_wrapper, mode='reduce-overhead')
+    # Mixed precision: bf16 autocast by default, fp16 needs loss scaling
+    amp_dtype = None
+    if device_type == 'cuda' and trn_para.get('amp', True):
+        amp_dtype = getattr(torch, trn_para.get('amp_dtype', 'bfloat16'))
+    scaler = None
+    if amp_dtype == torch.float16:
+        scaler = torch.amp.GradScaler('cuda')
 
     n_epochs = trn_para['n_epochs']
     if trn_para['loss_fn'] == 'MarginLoss':
@@ -241,8 +327,19 @@ def train(dataset, net_arch, trn_para, save, device_type='cuda', model_filename=
                 epoch=warmup_epoch,
                 n_epochs=trn_para['warmup'],
                 train=True,
+                channels_last=channels_last,
+                scaler=scaler,
+                amp_dtype=amp_dtype,
             )
             
+    # Capture the training step for the fixed shape batches
+    graphed_step = None
+    if use_cuda_graph:
+        input, target = next(iter(train_loader))
+        input, target = move_batch_to_device(input, target, device_type, channels_last)
+        model_wrapper.train()
+        graphed_step = GraphedStep(model_wrapper, criterion, input, target, scaler, amp_dtype)
+
     # Train model
     best_error = 1
     for epoch in range(1, n_epochs + 1):
@@ -256,6 +353,10 @@ def train(dataset, net_arch, trn_para, save, device_type='cuda', model_filename=
                 epoch=epoch,
                 n_epochs=n_epochs,
                 train=True,
+                channels_last=channels_last,
+                scaler=scaler,
+                amp_dtype=amp_dtype,
+                graphed_step=graphed_step,
             )
         else:
             run_epoch(
@@ -267,6 +368,10 @@ def train(dataset, net_arch, trn_para, save, device_type='cuda', model_filename=
                 epoch=epoch,
                 n_epochs=n_epochs,
                 train=True,
+                channels_last=channels_last,
+                scaler=scaler,
+                amp_dtype=amp_dtype,
+                graphed_step=graphed_step,
             )
         valid_results = run_epoch(
             loader=valid_loader,
@@ -277,6 +382,8 @@ def train(dataset, net_arch, trn_para, save, device_type='cuda', model_filename=
             epoch=epoch,
             n_epochs=n_epochs,
             train=False,
+            channels_last=channels_last,
+            amp_dtype=amp_dtype,
         )
 
         # Determine if model is the best
@@ -319,18 +426,27 @@ def calibrate(dataset, net_arch, trn_para, save, device_type, model_filename='mo
     state_dict = torch.load(model_filename)
 
     # Load original model
-    orig_model = get_model(net_arch)
+    orig_model = script_model(get_model(net_arch), net_arch, trn_para)
     orig_model=move_to_device(orig_model, device_type)
     orig_model.load_state_dict(state_dict)
     
     # data loader
     valid_loader=dataset.valid_loader
     
+    # Only used for inference here, fold BN into the preceding convs
+    eval_model = fuse_conv_bn(orig_model)
+    # The logits of every batch are kept, so compile without CUDA graphs
+    # ('reduce-overhead') which would overwrite them on the next replay
+    if device_type == 'cuda' and trn_para.get('compile', True) and not isinstance(orig_model, torch.jit.ScriptModule):
+        eval_model = torch.compile(eval_model)
+
     # wrap the model with a decorator that adds temperature scaling
-    model = ModelWithTemperature(orig_model)
+    model = ModelWithTemperature(eval_model)
 
     # Tune the model temperature, and save the results
     model.opt_temperature(valid_loader)
+    # save with the state dict keys of the uncompiled model
+    model.model = orig_model
     model_filename = os.path.join(save, calibrated_filename)
     torch.save(model.state_dict(), model_filename)
     print('Temperature scaled model sved to %s' % model_filename)
@@ -349,6 +465,12 @@ if __name__ == '__main__':
     """
     args = commandLineParser.parse_args()
 
+    # CIFAR batches have a fixed shape, so let cuDNN cache the fastest kernels,
+    # and route FP32 matmuls/convs to TF32 tensor cores on Ampere+
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     if not os.path.isdir('CMDs'):
         os.mkdir('CMDs')
     with open('CMDs/step_train_network.cmd', 'a') as f:
@@ -1,3 +1,4 @@
+import copy
 import numpy as np
 import os
 import time
@@ -99,6 +100,45 @@ def move_to_device(model, device_type, print_model_to_log=False, parallel=False)
         print(model_wrapper)
     return model_wrapper 
 
+def fuse_conv_bn(model):
+    """
+    Fold eval-mode BatchNorm layers into the convolutions that feed them.
+    Returns a fused copy of the model for inference, or the model itself
+    if there is nothing to fold or it cannot be traced by torch.fx.
+    Dense layers are fused module by module, their python control flow
+    (checkpointing) cannot be traced.
+    """
+    from torch.fx.experimental.optimization import fuse, matches_module_pattern
+    from torch.nn.utils.fusion import fuse_conv_bn_eval
+    from MLLib.models.densenet import _DenseLayer
+    model.eval()
+    if isinstance(model, torch.jit.ScriptModule):
+        return model
+
+    if any(isinstance(m, _DenseLayer) for m in model.modules()):
+        fused = copy.deepcopy(model)
+        for m in fused.modules():
+            if isinstance(m, _DenseLayer):
+                # conv1 -> norm2 is the only conv -> BN pair of a dense layer
+                m.conv1 = fuse_conv_bn_eval(m.conv1, m.norm2)
+                m.norm2 = nn.Identity()
+        return fused
+
+    try:
+        traced = torch.fx.symbolic_trace(model)
+    except torch.fx.proxy.TraceError as e:
+        print('Conv-BN fusion skipped: %s' % e)
+        return model
+    modules = dict(traced.named_modules())
+    # fuse() only folds a conv whose output feeds nothing but the BN
+    if not any(matches_module_pattern((nn.Conv2d, nn.BatchNorm2d), node, modules)
+               and len(node.args[0].users) == 1
+               for node in traced.graph.nodes):
+        # e.g. pre-activation nets, where a ReLU sits between BN and conv
+        # and the stem conv also feeds the first shortcut
+        return model
+    return fuse(traced, no_trace=True)
+
 class Meter():
     """
     A little helper class which keeps track of statistics during an epoch.
@@ -124,13 +164,14 @@ class Meter():
         Update the meter
         data (Tensor, or float): update value for the meter
             Size of data should match size of ``name'' in the initialized args
+        n (int): number of updates ``data'' is the average of - default 1
         """
         self._count = self._count + n
         if torch.is_tensor(data):
             self._last_value.copy_(data)
         else:
             self._last_value.fill_(data)
-        self._total.add_(self._last_value)
+        self._total.add_(self._last_value, alpha=n)
 
     def value(self):
         """
@@ -146,6 +187,106 @@ class Meter():
             for n, lv, v in zip(self.name, self._last_value, self.value())])
 
 
+class StepTimer():
+    """
+    Measures the time between calls to ``lap''. On cuda the time stamps are
+    events recorded on the current stream, so the host only waits for the
+    GPU when the time is read.
+    """
+    def __init__(self, device_type='cuda'):
+        self.cuda = device_type == 'cuda'
+        self.start = self._record()
+
+    def _record(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.time()
+
+    def lap(self):
+        """
+        Returns the seconds since the previous lap (or construction)
+        """
+        end = self._record()
+        if self.cuda:
+            end.synchronize()
+            elapsed = self.start.elapsed_time(end) / 1000.0
+        else:
+            elapsed = end - self.start
+        self.start = end
+        return elapsed
+
+
+class GraphedStep():
+    """
+    Forward, loss and backward of a training step, captured once in a CUDA
+    graph and replayed for every batch of the same shape to remove the
+    per-kernel launch overhead. The optimizer step stays outside the graph,
+    so lr schedules keep working. Gradients are written to the .grad tensors
+    allocated during capture, they must not be set to None afterwards.
+    """
+    def __init__(self, model, criterion, input, target, scaler=None, amp_dtype=None, n_warmup=3):
+        """
+        input, target (Tensor): a batch on the gpu, fixes the captured shapes
+        scaler (GradScaler): scales the loss before backward, if given
+        amp_dtype (torch.dtype): autocast dtype, None to run in full precision
+        """
+        self.model = model
+        self.criterion = criterion
+        self.scaler = scaler
+        self.amp_dtype = amp_dtype
+        self.static_input = input.clone()
+        self.static_target = target.clone()
+
+        # the warmup iterations update the BatchNorm running stats, keep a
+        # copy to restore once the graph is captured
+        buffers = {name: buf.clone() for name, buf in model.named_buffers()}
+
+        # torch.cuda.graph needs a few warmup iterations on a side stream
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(n_warmup):
+                model.zero_grad(set_to_none=True)
+                self._forward_backward()
+        torch.cuda.current_stream().wait_stream(stream)
+
+        # grads are None, so backward allocates them from the graph's pool
+        model.zero_grad(set_to_none=True)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_output, self.static_loss = self._forward_backward()
+
+        # in place, the captured graph reads and updates these same tensors
+        with torch.no_grad():
+            for name, buf in model.named_buffers():
+                buf.copy_(buffers[name])
+
+    def _forward_backward(self):
+        with torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.amp_dtype is not None, cache_enabled=False):
+            output = self.model(self.static_input)
+            loss = self.criterion(output, self.static_target)
+        if self.scaler is not None:
+            self.scaler.scale(loss).backward()
+        else:
+            loss.backward()
+        return output, loss
+
+    def matches(self, input):
+        return input.shape == self.static_input.shape
+
+    def __call__(self, input, target):
+        """
+        Replays the step on a batch and returns its output and loss. These are
+        the graph's static tensors, overwritten by the next replay.
+        """
+        self.static_input.copy_(input, non_blocking=True)
+        self.static_target.copy_(target, non_blocking=True)
+        self.graph.replay()
+        return self.static_output, self.static_loss
+
+
 def prob_to_logit(probs, epsilon=1e-7):
     #convert probability (along the last axis) into logits 
     probs = torch.clamp(probs, epsilon, 1-epsilon)